@@ -1,6 +1,11 @@
 from jitlog import constants as const
 from vmshare.binary import read_string, read_le_u64
 
+try:
+    from sys import intern
+except ImportError:
+    pass # python 2, intern is a builtin
+
 class MergePointDecoder(object):
     def __init__(self, sem_type):
         self.sem_type = sem_type
@@ -18,13 +23,13 @@ class StrMergePointDecoder(MergePointDecoder):
     def decode(self, fileobj):
         type = fileobj.read(1)
         if type == b'\xef':
-            return self.last_prefix[:]
+            return intern(self.last_prefix)
         string = read_string(fileobj, True)
         if type == b'\x00':
-            return self.last_prefix + string
+            return intern(self.last_prefix + string)
         else:
             assert type == b'\xff'
-            return string
+            return intern(string)
 
 def get_decoder(sem_type, gen_type, version):
     assert 0 <= sem_type <= const.MP_OPCODE[0]
@@ -7,19 +7,56 @@ from jitlog import constants as const, merge_point
 
 PY3 = sys.version_info[0] >= 3
 
+try:
+    from sys import intern
+except ImportError:
+    pass # python 2, intern is a builtin
+
+# maps the trace marks to the name of the stage they start
+STAGE_NAMES = {
+    const.MARK_TRACE: 'noopt',
+    const.MARK_TRACE_OPT: 'opt',
+    const.MARK_TRACE_ASM: 'asm',
+}
+
+# every one byte marker from MARK_JITLOG_START up to MARK_JITLOG_END
+JITLOG_MARKERS = frozenset([struct.pack("B", i) for i in
+    range(ord(const.MARK_JITLOG_START), ord(const.MARK_JITLOG_END) + 1)])
+
+# layout of MARK_SOURCE_CODE: the file name length, the line count
+# and lineno, indent and length preceding each line
+SOURCE_FILE_HEADER = struct.Struct('<I')
+SOURCE_LINE_COUNT = struct.Struct('<H')
+SOURCE_LINE_HEADER = struct.Struct('<HBI')
+
+# memory patches are looked up in buckets of 64 KiB
+PATCH_BUCKET_SHIFT = 16
+
 class FlatOp(object):
+    __slots__ = ('opnum', 'opname', 'args', 'result', 'descr', 'descr_number',
+                 'core_rel_pos', 'core_bytes', 'failargs', 'index', 'linkid',
+                 '_repr')
+
+    is_merge_point = False
+
     def __init__(self, opnum, opname, args, result,
                  descr=None, descr_number=None, failargs=None):
         self.opnum = opnum
         self.opname = opname
-        self.args = args
+        # the same variable names show up in thousands of operations
+        self.args = tuple([intern(arg) for arg in args]) if args else ()
         self.result = result
         self.descr = descr
         self.descr_number = descr_number
-        self.core_dump = None
+        # position relative to the trace start and machine code of this op
+        self.core_rel_pos = -1
+        self.core_bytes = None
+        if failargs:
+            failargs = tuple([intern(arg) for arg in failargs])
         self.failargs = failargs
         self.index = -1
         self.linkid = -1 # a unique id that is generated from the descr_number
+        self._repr = None
 
     def get_name(self):
         return self.opname
@@ -45,24 +82,51 @@ class FlatOp(object):
         return "guard" in self.opname
 
     def set_core_dump(self, rel_pos, core_dump):
-        self.core_dump = (rel_pos, core_dump)
+        self.core_rel_pos = rel_pos
+        self.core_bytes = core_dump
+
+    def has_core_dump(self):
+        return self.core_bytes is not None
+
+    @property
+    def core_dump(self):
+        if self.core_bytes is None:
+            return None
+        return (self.core_rel_pos, self.core_bytes)
 
     def get_core_dump(self, base_addr, patches, timeval):
-        coredump = self.core_dump[1][:]
+        buf = bytearray(len(self.core_bytes))
+        self.write_core_dump(buf, 0, base_addr, patches, timeval)
+        return bytes(buf)
+
+    def write_core_dump(self, buf, offset, base_addr, patches, timeval):
+        """ copy the core dump of this operation into buf at offset and
+        apply the patches up to timeval. returns the offset after the dump """
+        op_off = self.core_rel_pos
+        size = len(self.core_bytes)
+        buf[offset:offset+size] = self.core_bytes
+        # patches are sorted by the time they were applied
         for timepos, addr, content in patches:
             if timeval < timepos:
-                continue # do not apply the patch
-            op_off = self.core_dump[0]
-            patch_start = (addr - base_addr) - op_off 
-            patch_end = patch_start + len(content)
-            content_end = len(content)-1
-            if patch_end >= len(coredump):
-                patch_end = len(coredump)
-                content_end = patch_end - patch_start
-            coredump = coredump[:patch_start] + content[:content_end] + coredump[patch_end:]
-        return coredump
+                break # neither this nor the following patches apply
+            patch_start = (addr - base_addr) - op_off
+            patch_end = min(patch_start + len(content), size)
+            content_start = 0
+            if patch_start < 0:
+                # the patch starts in front of this operation
+                content_start = -patch_start
+                patch_start = 0
+            if patch_start >= patch_end:
+                continue # the patch does not touch this operation
+            content_end = content_start + (patch_end - patch_start)
+            buf[offset+patch_start:offset+patch_end] = \
+                    content[content_start:content_end]
+        return offset + size
 
     def __repr__(self):
+        # operations do not change after parsing, format them only once
+        if self._repr is not None:
+            return self._repr
         suffix = ''
         if self.result is not None:
             suffix = "%s = " % self.result
@@ -71,13 +135,25 @@ class FlatOp(object):
             descr = ''
         else:
             descr = ', @' + str(descr)
-        return '%s%s(%s%s)' % (suffix, self.opname,
-                                ', '.join(self.args), descr)
+        self._repr = '%s%s(%s%s)' % (suffix, self.opname,
+                                     ', '.join(self.args), descr)
+        return self._repr
 
 class MergePoint(FlatOp):
+    __slots__ = ('values', '_source_line')
+
+    is_merge_point = True
+
     def __init__(self, values):
         assert isinstance(values, dict)
         self.values = values
+        # the source line is queried for every merge point while parsing
+        filename = values.get(const.MP_FILENAME[0], None)
+        lineno = values.get(const.MP_LINENO[0], None)
+        if filename is None or lineno is None:
+            self._source_line = (0, None)
+        else:
+            self._source_line = (lineno, filename)
 
     def get_name(self):
         return ""
@@ -92,16 +168,7 @@ class MergePoint(FlatOp):
         return ""
 
     def get_source_line(self):
-        filename = None
-        lineno = None
-        for sem_type, value in self.values.items():
-            if sem_type == const.MP_FILENAME[0]:
-                filename = value
-            if sem_type == const.MP_LINENO[0]:
-                lineno = value
-        if filename is None or lineno is None:
-            return 0, None
-        return lineno, filename
+        return self._source_line
 
     def has_descr(self, descr=None):
         return False
@@ -109,19 +176,29 @@ class MergePoint(FlatOp):
     def set_core_dump(self, rel_pos, core_dump):
         raise NotImplementedError
 
+    def has_core_dump(self):
+        return False
+
     def get_core_dump(self, base_addr, patches, timeval):
         raise NotImplementedError
 
+    def write_core_dump(self, buf, offset, base_addr, patches, timeval):
+        raise NotImplementedError
+
     def __repr__(self):
         return 'debug_merge_point(xxx)'
 
 class Stage(object):
+    __slots__ = ('mark', 'ops', 'merge_points', 'timeval', 'stitch_points',
+                 'merge_point_types')
+
     def __init__(self, mark, timeval):
         self.mark = mark
         self.ops = []
         self.merge_points = []
         self.timeval = timeval
         self.stitch_points = []
+        self.merge_point_types = None
 
     def getoperations(self):
         return self.ops
@@ -138,7 +215,7 @@ class Stage(object):
 
     def append_op(self, op):
         op.index = len(self.ops)
-        if isinstance(op, MergePoint):
+        if op.is_merge_point:
             self.merge_points.append(op)
         else:
             self.ops.append(op)
@@ -164,6 +241,11 @@ class TraceLink(namedtuple('TraceLink', 'origin target')):
     pass
 
 class Trace(object):
+    __slots__ = ('forest', 'jd_name', 'type', 'inputargs', 'unique_id',
+                 'stages', 'last_mark', 'addrs', 'my_patches', 'counter',
+                 'point_counters', 'merge_point_files', 'descr_number',
+                 'links_up', 'links', 'stamp')
+
     def __init__(self, forest, trace_type, tick, unique_id, jd_name=None):
         self.forest = forest
         self.jd_name = jd_name
@@ -229,25 +311,18 @@ class Trace(object):
         return self.stages.get(type, None)
 
     def start_mark(self, mark):
-        mark_name = 'noopt'
-        if mark == const.MARK_TRACE_OPT:
-            mark_name = 'opt'
-        elif mark == const.MARK_TRACE_ASM:
-            mark_name = 'asm'
-        else:
-            assert mark == const.MARK_TRACE
-            if self.last_mark == mark_name:
-                # NOTE unrolling
-                #
-                # this case means that the optimizer has been invoked
-                # twice (see compile_loop in rpython/jit/metainterp/compile.py)
-                # and the loop was unrolled in between.
-                #
-                # we just return here, which means the following ops will just append the loop
-                # ops to the preamble ops to the current stage!
-                return
+        mark_name = STAGE_NAMES[mark]
+        if mark_name == 'noopt' and self.last_mark == mark_name:
+            # NOTE unrolling
+            #
+            # this case means that the optimizer has been invoked
+            # twice (see compile_loop in rpython/jit/metainterp/compile.py)
+            # and the loop was unrolled in between.
+            #
+            # we just return here, which means the following ops will just append the loop
+            # ops to the preamble ops to the current stage!
+            return
         self.last_mark = mark_name
-        assert mark_name is not None
         if mark_name in self.stages:
             return self.stages[mark_name]
         tick = self.forest.timepos
@@ -266,6 +341,13 @@ class Trace(object):
     def add_instr(self, op):
         stage = self.get_stage(self.last_mark)
         stage.append_op(op)
+        if op.is_merge_point:
+            lineno, filename = op.get_source_line()
+            if filename:
+                self.merge_point_files[filename].append(lineno)
+            return
+
+        name = op.get_name()
         if stage.is_asm():
             if op.has_descr():
                 stage.stitch_points.append(PointInTrace(self, op))
@@ -273,20 +355,20 @@ class Trace(object):
                 if nmr == 0x0:
                     sys.stderr.write("descr in trace %s should not be 0x0\n" % self)
                 else:
-                    dict = self.forest.descr_nmr_to_point_in_trace
+                    points = self.forest.descr_nmr_to_point_in_trace
                     # a label could already reside in that position
-                    if nmr not in dict:
-                        dict[nmr] = PointInTrace(self, op)
+                    if nmr not in points:
+                        points[nmr] = PointInTrace(self, op)
                     else:
                         pass
                         #sys.stderr.write("duplicate descr: 0x%x\n" % nmr)
 
-                if op.get_name() == "label":
+                if name == "label":
                     self.forest.labels[nmr] = PointInTrace(self, op)
-                if op.get_name() == "jump":
+                elif name == "jump":
                     self.forest.jumps[nmr] = PointInTrace(self, op)
 
-        if op.get_name() == "increment_debug_counter":
+        if name == "increment_debug_counter":
             prev_op = stage.get_op(op.index-1)
             # look for the previous operation, it is a label saved
             # in descr_number_to_point_in_trace
@@ -295,11 +377,6 @@ class Trace(object):
                 pit = self.forest.get_point_in_trace_by_descr(descr_number)
                 pit.set_inc_op(op)
 
-        if isinstance(op, MergePoint):
-            lineno, filename = op.get_source_line()
-            if filename:
-                self.merge_point_files[filename].append(lineno)
-
     def is_bridge(self):
         return self.type == 'bridge'
 
@@ -332,24 +409,31 @@ class Trace(object):
             timeval = 2**31-1 # a very high number
         if self.my_patches is None:
             self.my_patches = []
-            for patch in self.forest.patches:
-                patch_time, addr, content = patch
-                if self.contains_patch(addr):
-                    self.my_patches.append(patch)
+            buckets = self.forest.patch_buckets
+            first = self.addrs[0] >> PATCH_BUCKET_SHIFT
+            last = self.addrs[1] >> PATCH_BUCKET_SHIFT
+            for key in range(first, last + 1):
+                for patch in buckets.get(key, ()):
+                    patch_time, addr, content = patch
+                    if self.contains_patch(addr):
+                        self.my_patches.append(patch)
+            self.my_patches.sort(key=lambda patch: patch[0])
 
-        core_dump = []
-        start,end = opslice
-        if end == -1:
-            end = len(opslice)
-        ops = None
         stage = self.get_stage('asm')
         if not stage:
             return None # no core dump!
-        for i, op in enumerate(stage.get_ops()):
-            if start <= i <= end:
-                dump = op.get_core_dump(self.addrs[0], self.my_patches, timeval)
-                core_dump.append(dump)
-        return ''.join(core_dump)
+        ops = stage.get_ops()
+        start,end = opslice
+        if end == -1:
+            end = len(ops) - 1
+        ops = [op for op in ops[start:end+1] if op.has_core_dump()]
+        # all dumps are written into a single buffer of the final size
+        core_dump = bytearray(sum([len(op.core_bytes) for op in ops]))
+        offset = 0
+        for op in ops:
+            offset = op.write_core_dump(core_dump, offset, self.addrs[0],
+                                        self.my_patches, timeval)
+        return bytes(core_dump)
 
     def get_name(self):
         stage = self.get_stage('opt')
@@ -370,21 +454,17 @@ class Trace(object):
         return 'Trace(%d, 0x%x, %d)' % (self.unique_id, id(self), len(self.stages))
 
 def iter_ranges(numbers):
+    """ yield ranges that cover all numbers. a new range is started
+    as soon as a number is more than 50 apart from the current start """
     if len(numbers) == 0:
-        raise StopIteration
-    numbers.sort()
-    first = numbers[0]
-    last = numbers[0]
-    for pos, i in enumerate(numbers[1:]):
+        return
+    numbers = sorted(set(numbers))
+    first = last = numbers[0]
+    for i in numbers[1:]:
         if (i - first) > 50:
             yield range(first, last+1)
-            if pos+1 < len(numbers):
-                last = i
-                first = i
-            else:
-                raise StopIteration
-        else:
-            last = i
+            first = i
+        last = i
     yield range(first, last+1)
 
 class PointInTrace(object):
@@ -427,6 +507,11 @@ def decode_source(source_bytes):
     newline_decoder = _io.IncrementalNewlineDecoder(None, True)
     return newline_decoder.decode(source_bytes.decode(encoding[0]))
 
+def encode_utf8(text):
+    if isinstance(text, bytes):
+        return text
+    return text.encode('utf-8')
+
 def read_python_source(file):
     with open(file, 'rb') as fd:
         data = fd.read()
@@ -446,6 +531,8 @@ class TraceForest(object):
         self.resops = {}
         self.timepos = 0
         self.patches = []
+        # patches grouped by their address >> PATCH_BUCKET_SHIFT
+        self.patch_buckets = defaultdict(list)
         self.stitches = {}
         self.filepath = None
         # a mapping from source file name -> {lineno: (indent, line)}
@@ -491,26 +578,26 @@ class TraceForest(object):
             # to the jitlog, thus it will yield many duplicates. If there
             # is already source code attached, we skip this step
             return False
-        file_contents = {}
+        # group the line numbers by file first. this way each source file
+        # is read once and released before the next one is loaded
+        file_linenos = defaultdict(list)
         for _, trace in self.traces.items():
             for file, lines in trace.merge_point_files.items():
-                if file not in file_contents:
-                    if not os.path.exists(file):
-                        continue
-                    code = read_python_source(file)
-                    file_contents[file] = code.splitlines()
-
-                split_lines = file_contents[file]
-                saved_lines = self.source_lines[file]
+                file_linenos[file].append(lines)
+
+        for file, trace_lines in file_linenos.items():
+            if not os.path.exists(file):
+                continue
+            split_lines = read_python_source(file).splitlines()
+            saved_lines = self.source_lines[file]
+            for lines in trace_lines:
                 for int_range in iter_ranges(lines):
                     for r in int_range:
                         line = split_lines[r-1]
                         data = line.lstrip()
                         diff = len(line) - len(data)
-                        indent = diff
-                        for i in range(0, diff):
-                            if line[i] == '\t':
-                                indent += 7
+                        # a tab counts as 8 columns
+                        indent = diff + line[:diff].count('\t') * 7
                         saved_lines[r] = (indent, data)
         return True
 
@@ -555,38 +642,54 @@ class TraceForest(object):
         return self.stitches.get(descr_number)
 
     def patch_memory(self, addr, content, timeval):
-        self.patches.append((timeval, addr, content))
+        patch = (timeval, addr, content)
+        self.patches.append(patch)
+        self.patch_buckets[addr >> PATCH_BUCKET_SHIFT].append(patch)
 
     def time_tick(self):
         self.timepos += 1
 
     def is_jitlog_marker(self, marker):
-        if len(marker) == 0:
-            return False
-        assert len(marker) == 1
-        return const.MARK_JITLOG_START <= marker <= const.MARK_JITLOG_END
+        return marker in JITLOG_MARKERS
 
     def encode_source_code_lines(self):
-        marks = []
+        # encode the strings first, the blob is then packed
+        # into a buffer of the exact size
+        files = []
+        size = 0
         for filename, lines in self.source_lines.items():
-            marks.append(const.MARK_SOURCE_CODE)
-            data = filename
-            if PY3:
-                data = data.encode('utf-8')
-            marks.append(struct.pack('<I', len(data)))
-            marks.append(data)
-
-            marks.append(struct.pack('<H', len(lines)))
-            for lineno, (indent, line) in lines.items():
-                marks.append(struct.pack('<HBI', lineno, indent, len(line)))
-                marks.append(line.encode('utf-8'))
-        return b''.join(marks)
+            filename = encode_utf8(filename)
+            encoded = [(lineno, indent, encode_utf8(line))
+                       for lineno, (indent, line) in lines.items()]
+            size += 1 + SOURCE_FILE_HEADER.size + len(filename) + \
+                    SOURCE_LINE_COUNT.size
+            for _, _, line in encoded:
+                size += SOURCE_LINE_HEADER.size + len(line)
+            files.append((filename, encoded))
+
+        buf = bytearray(size)
+        offset = 0
+        for filename, lines in files:
+            buf[offset:offset+1] = const.MARK_SOURCE_CODE
+            offset += 1
+            SOURCE_FILE_HEADER.pack_into(buf, offset, len(filename))
+            offset += SOURCE_FILE_HEADER.size
+            buf[offset:offset+len(filename)] = filename
+            offset += len(filename)
+            SOURCE_LINE_COUNT.pack_into(buf, offset, len(lines))
+            offset += SOURCE_LINE_COUNT.size
+            for lineno, indent, line in lines:
+                SOURCE_LINE_HEADER.pack_into(buf, offset, lineno, indent, len(line))
+                offset += SOURCE_LINE_HEADER.size
+                buf[offset:offset+len(line)] = line
+                offset += len(line)
+        return bytes(buf)
 
     def add_source_code_line(self, filename, lineno, indent, line):
-        dict = self.source_lines[filename]
-        if lineno in dict:
+        lines = self.source_lines[filename]
+        if lineno in lines:
             sys.stderr.write("dup source code. %s line %d\n" % (filename, lineno))
-        dict[lineno] = (indent, line)
+        lines[lineno] = (indent, line)
 
     def add_tmp_callback(self, descr_nmr, uid=-1):
         self.redirect_descrs[descr_nmr] = uid
@@ -24,8 +24,9 @@ class PrettyPrinter(object):
         for name, stage in trace.stages.items():
             fd.write(self.stage_name(stage))
             fd.write("\n")
-            for op in stage.getoperations():
-                fd.write('  ' + self.op(op) + '\n')
+            # one write per stage instead of one per operation
+            fd.write(''.join(['  %s\n' % self.op(op)
+                              for op in stage.getoperations()]))
 
     def var(self, var):
         return var
@@ -34,3 +34,11 @@ def test_merge_point_extract_source_code(encoding,text,decoded,bom,tmpdir):
         assert line == (0, "print(\"" + decoded + "\")")
     else:
         assert line == (0, "print(\"" + text + "\")")
+
+def test_encode_source_code_line_length_in_bytes():
+    forest = TraceForest(1)
+    forest.add_source_code_line("x.py", 1, 0, u"a = 'é'")
+    assert forest.encode_source_code_lines() == \
+            b'\x22\x04\x00\x00\x00x.py' \
+            b'\x01\x00' \
+            b'\x01\x00\x00\x08\x00\x00\x00a = \'\xc3\xa9\''
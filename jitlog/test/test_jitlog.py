@@ -72,12 +72,22 @@ def test_patch_asm_timeval():
     trace.start_mark(const.MARK_TRACE_ASM)
     trace.set_addr_bounds(0, 9)
     trace.add_instr(FlatOp(0, 'hello', ['world'], None, None))
-    trace.get_stage('asm').get_last_op().set_core_dump(0, 'abcdef')
+    trace.get_stage('asm').get_last_op().set_core_dump(0, b'abcdef')
     trace.add_instr(FlatOp(0, 'add', ['i1', 'i2'], 'i3', None))
-    trace.get_stage('asm').get_last_op().set_core_dump(6, 'a312')
-    forest.patch_memory(4, '4321', 1)
-    trace.get_core_dump(0) == "abcdefa312"
-    trace.get_core_dump(1) == "abcd432112"
+    trace.get_stage('asm').get_last_op().set_core_dump(6, b'a312')
+    forest.patch_memory(4, b'4321', 1)
+    assert trace.get_core_dump(0) == b"abcdefa312"
+    assert trace.get_core_dump(1) == b"abcd432112"
+
+def test_patch_asm_clamped():
+    op = FlatOp(0, 'hello', ['world'], None, None)
+    op.set_core_dump(2, b'abcd')
+    # patch covers the whole operation and bytes on both sides
+    assert op.get_core_dump(0, [(0, 1, b'123456')], 0) == b'2345'
+    # patch ends at the last byte of the operation
+    assert op.get_core_dump(0, [(0, 4, b'xy')], 0) == b'abxy'
+    # patch lies outside of the operation
+    assert op.get_core_dump(0, [(0, 6, b'xy')], 0) == b'abcd'
 
 def test_counters():
     descr_nmr = encode_le_u64(10)
@@ -169,6 +179,7 @@ def test_iter_ranges():
     assert list(iter_ranges([14,25,100])) == [r(14,26),r(100,101)]
     assert list(iter_ranges([-1,2])) == [r(-1,2+1)]
     assert list(iter_ranges([0,1,100,101,102,300,301])) == [r(0,2),r(100,103),r(300,302)]
+    assert list(iter_ranges([7,3,7,5])) == [r(3,8)]
 
 def test_read_jitlog_counter():
     forest = TraceForest(1)
@@ -326,3 +337,70 @@ def test_failing_guard():
     forest.stitch_bridge(15, 42)
     assert trace2.get_failing_guard() == op
 
+
+def test_flatop_args_are_shared():
+    a = FlatOp(0, 'int_add', ['i1', 'i2'], 'i3')
+    b = FlatOp(0, 'int_add', [''.join(['i', '1']), 'i4'], 'i5')
+    assert a.args == ('i1', 'i2')
+    assert a.args[0] is b.args[0]
+    assert FlatOp(0, 'jump', '', '?').args == ()
+
+def test_is_jitlog_marker():
+    forest = TraceForest(1)
+    assert forest.is_jitlog_marker(const.MARK_JITLOG_START)
+    assert forest.is_jitlog_marker(const.MARK_SOURCE_CODE)
+    assert forest.is_jitlog_marker(const.MARK_JITLOG_END)
+    assert not forest.is_jitlog_marker(b'')
+    assert not forest.is_jitlog_marker(b'\x0f')
+    assert not forest.is_jitlog_marker(b'\x26')
+
+def test_patch_asm_only_own_patches():
+    forest = TraceForest(1)
+    trace = Trace(forest, 'loop', 0, 0)
+    trace.start_mark(const.MARK_TRACE_ASM)
+    trace.set_addr_bounds(0x10000, 0x10005)
+    trace.add_instr(FlatOp(0, 'hello', ['world'], None, None))
+    trace.get_stage('asm').get_last_op().set_core_dump(0, b'abcdef')
+    forest.patch_memory(0x10002, b'xx', 3)
+    forest.patch_memory(0x10003, b'y', 1)
+    forest.patch_memory(0x20002, b'zz', 2) # another trace
+    assert trace.get_core_dump(0) == b'abcdef'
+    assert trace.get_core_dump(2) == b'abcyef'
+    assert trace.get_core_dump(3) == b'abxxef'
+
+def test_patch_asm_opslice():
+    forest = TraceForest(1)
+    trace = Trace(forest, 'loop', 0, 0)
+    trace.start_mark(const.MARK_TRACE_ASM)
+    trace.set_addr_bounds(0, 9)
+    for i, dump in enumerate([b'ab', b'cd', b'ef', b'gh']):
+        trace.add_instr(FlatOp(0, 'op', [], None, None))
+        trace.get_stage('asm').get_last_op().set_core_dump(i*2, dump)
+    forest.patch_memory(3, b'XY', 1)
+    assert trace.get_core_dump() == b'abcXYfgh'
+    assert trace.get_core_dump(0) == b'abcdefgh'
+    assert trace.get_core_dump(1, (1,2)) == b'cXYf'
+    assert trace.get_core_dump(1, (3,-1)) == b'gh'
+
+def test_merge_point_extract_tab_indent(tmpdir):
+    file = tmpdir.join("tabs.py")
+    file.write_binary(b"def f(a):\n\t  \treturn a\n")
+    forest = TraceForest(1)
+    trace = forest.add_trace('loop', 0, 0)
+    trace.start_mark(const.MARK_TRACE_OPT)
+    trace.add_instr(MergePoint({0x1: str(file), 0x2: 2}))
+    forest.extract_source_code_lines()
+    assert forest.source_lines[str(file)][2] == (18, 'return a')
+
+def test_core_dump_skips_ops_without_dump():
+    forest = TraceForest(1)
+    trace = Trace(forest, 'loop', 0, 0)
+    trace.start_mark(const.MARK_TRACE_ASM)
+    trace.set_addr_bounds(0, 9)
+    trace.add_instr(FlatOp(0, 'label', [], None, None))
+    trace.add_instr(FlatOp(0, 'int_add', ['i1', 'i2'], 'i3', None))
+    op = trace.get_stage('asm').get_last_op()
+    op.set_core_dump(0, b'abcd')
+    assert not trace.get_stage('asm').get_op(0).has_core_dump()
+    assert op.core_dump == (0, b'abcd')
+    assert trace.get_core_dump() == b'abcd'